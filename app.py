@@ -1,10 +1,16 @@
-import os, re, secrets, uuid
+import hashlib, json, os, re, secrets, shutil, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, abort, make_response, after_this_request
+import orjson
+from flask import Flask, g, render_template, request, redirect, url_for, session, send_file, abort, make_response, after_this_request
+from flask.json.provider import JSONProvider
+from flask_session import Session
+from cachelib.file import FileSystemCache
 from markupsafe import escape
 from werkzeug.utils import secure_filename
-from utils.docx_utils import extract_placeholders, replace_placeholders, build_preview_text
+from utils.docx_utils import build_scaffold, scaffold_placeholders, render_scaffold, replace_placeholders, build_preview_text
 
 APP_DIR = Path(__file__).parent.resolve()
 UPLOAD_DIR = APP_DIR / "uploads"
@@ -14,8 +20,83 @@ SAMPLE_PATH = APP_DIR / "sample_docs" / "sample_safe.docx"
 UPLOAD_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# Parse the bundled sample once at process start: /use-sample becomes pure
+# session initialization with zero docx I/O. The scaffold file is shared by
+# every sample session, so it is written once here and never unlinked.
+SAMPLE_SCAFFOLD = build_scaffold(str(SAMPLE_PATH)) if SAMPLE_PATH.exists() else []
+SAMPLE_SCAFFOLD_PATH = UPLOAD_DIR / "sample_scaffold.json"
+if SAMPLE_SCAFFOLD:
+    SAMPLE_SCAFFOLD_PATH.write_bytes(orjson.dumps(SAMPLE_SCAFFOLD))
+
+SESSION_DIR = APP_DIR / "flask_session"
+
+class OrjsonProvider(JSONProvider):
+    """orjson-backed JSON for jsonify and |tojson — several times faster
+    than stdlib json on the dict payloads this app deals in."""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", secrets.token_hex(16))
+app.json = OrjsonProvider(app)
+
+# Server-side sessions: the cookie carries only a session id, so chat_history
+# and mapping no longer round-trip through (and eventually overflow) a ~4 KB
+# signed cookie on every request.
+app.config["SESSION_TYPE"] = "cachelib"
+app.config["SESSION_CACHELIB"] = FileSystemCache(str(SESSION_DIR), threshold=500)
+# Binary msgpack encoding for the stored session payload — markedly faster
+# than Flask's tagged-JSON cookie serializer for the chat/mapping dicts.
+# Pinned explicitly so a library default change can't silently regress it.
+app.config["SESSION_SERIALIZATION_FORMAT"] = "msgpack"
+# Without this, Flask's default refresh-each-request behaviour makes
+# Flask-Session upsert the store file and re-send the cookie on every
+# request — read-only fragment polls included. Sessions get a fixed
+# expiry from their last modification instead of a sliding one.
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+Session(app)
+
+# Bound upload size so the multipart parser never chews through an
+# arbitrarily large body; .docx templates are well under this.
+app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Download jobs run off the request thread; results land in OUTPUT_DIR so
+# any gunicorn worker can serve the finished file, not just the one that
+# started the job.
+_executor = ThreadPoolExecutor(max_workers=4)
+
+JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+# Jobs the user abandons (refreshing /download, never clicking the link)
+# would otherwise accumulate in OUTPUT_DIR forever.
+JOB_TTL_SECONDS = 15 * 60
+
+def _sweep_output_dir() -> None:
+    """Delete job artifacts older than JOB_TTL_SECONDS."""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    for path in OUTPUT_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+@app.before_request
+def _load_session_views() -> None:
+    """Materialize the hot session collections once per request.
+
+    Endpoints read g.placeholders / g.mapping instead of repeatedly pulling
+    (and re-materializing) the same lists and dicts out of the session;
+    mutating endpoints write the g view back explicitly.
+    """
+    g.placeholders = session.get("placeholders") or []
+    g.mapping = dict(session.get("mapping") or {})
 
 def _is_filled(value: str | None) -> bool:
     if value is None:
@@ -24,6 +105,7 @@ def _is_filled(value: str | None) -> bool:
         return value.strip() != ""
     return True
 
+@lru_cache(maxsize=4096)
 def _humanize_placeholder(placeholder: str | None) -> str:
     if not placeholder:
         return ""
@@ -34,18 +116,39 @@ def _humanize_placeholder(placeholder: str | None) -> str:
     inner = re.sub(r"\s+", " ", inner).strip()
     return inner
 
+# The transcript in the browser accumulates bubbles client-side (HTMX swaps
+# with beforeend), so the server only needs a short tail for page reloads.
+CHAT_HISTORY_LIMIT = 20
+
+def _append_chat(*entries: dict) -> None:
+    chat_history = session.get("chat_history") or []
+    chat_history.extend(entries)
+    session["chat_history"] = chat_history[-CHAT_HISTORY_LIMIT:]
+
 def _reset_state() -> None:
     session.pop("doc_path", None)
     session.pop("doc_name", None)
     session.pop("placeholders", None)
     session.pop("mapping", None)
     session.pop("current_key", None)
+    scaffold_path = session.pop("scaffold_path", None)
+    if scaffold_path and scaffold_path != str(SAMPLE_SCAFFOLD_PATH):
+        try:
+            Path(scaffold_path).unlink(missing_ok=True)
+        except OSError:
+            pass
     session["chat_history"] = []
     session["filled_count"] = 0
     session["total_placeholders"] = 0
 
-def _initialize_workflow(doc_path: str, placeholders: list[str], doc_name: str, intro_template: str | None = None) -> None:
+def _initialize_workflow(doc_path: str, scaffold: list[dict], doc_name: str, intro_template: str | None = None, scaffold_path: str | None = None) -> None:
     _reset_state()
+    placeholders = scaffold_placeholders(scaffold)
+    if scaffold_path is None:
+        path = UPLOAD_DIR / f"{uuid.uuid4().hex}_scaffold.json"
+        path.write_bytes(orjson.dumps(scaffold))
+        scaffold_path = str(path)
+    session["scaffold_path"] = scaffold_path
     session["doc_path"] = doc_path
     session["doc_name"] = doc_name
     session["placeholders"] = placeholders
@@ -83,12 +186,17 @@ def index():
 @app.post("/use-sample")
 def use_sample():
     doc_path = str(SAMPLE_PATH)
-    placeholders = extract_placeholders(doc_path)
     intro = (
         "Sample SAFE loaded! {count} placeholder{plural} ready to fill. "
         "Let's start with <b>{friendly_first}</b> <span class=\"muted\">({raw_first})</span>."
     )
-    _initialize_workflow(doc_path, placeholders, "YC SAFE (sample)", intro_template=intro)
+    _initialize_workflow(
+        doc_path,
+        SAMPLE_SCAFFOLD,
+        "YC SAFE (sample)",
+        intro_template=intro,
+        scaffold_path=str(SAMPLE_SCAFFOLD_PATH),
+    )
     return redirect(url_for("chat"))
 
 @app.post("/upload")
@@ -102,20 +210,21 @@ def upload():
 
     unique_name = f"{Path(filename).stem}_{uuid.uuid4().hex}.docx"
     save_path = UPLOAD_DIR / unique_name
-    uploaded_file.save(save_path)
+    with open(save_path, "wb") as out:
+        shutil.copyfileobj(uploaded_file.stream, out, UPLOAD_CHUNK_SIZE)
 
-    placeholders = extract_placeholders(str(save_path))
+    scaffold = build_scaffold(str(save_path))
     display_name = Path(uploaded_file.filename).name if uploaded_file.filename else filename
     intro = (
         "I found {count} placeholder{plural}. Let's start with <b>{friendly_first}</b> "
         '<span class="muted">({raw_first})</span>.'
     )
-    _initialize_workflow(str(save_path), placeholders, display_name, intro_template=intro)
+    _initialize_workflow(str(save_path), scaffold, display_name, intro_template=intro)
     return redirect(url_for("chat"))
 
 def _next_key() -> str | None:
-    placeholders = session.get("placeholders") or []
-    mapping = session.get("mapping") or {}
+    placeholders = g.placeholders
+    mapping = g.mapping
     current = session.get("current_key")
     if current and current in placeholders:
         return current
@@ -124,9 +233,9 @@ def _next_key() -> str | None:
             return key
     return None
 
-def _get_workflow_state() -> dict[str, Any]:
-    placeholders = session.get("placeholders") or []
-    mapping = session.get("mapping") or {}
+def _compute_workflow_state() -> dict[str, Any]:
+    placeholders = g.placeholders
+    mapping = g.mapping
     next_key = _next_key()
     total = len(placeholders)
     filled = sum(1 for key in placeholders if _is_filled(mapping.get(key)))
@@ -144,10 +253,6 @@ def _get_workflow_state() -> dict[str, Any]:
             "is_active": key == next_key,
         })
 
-    session["filled_count"] = filled
-    session["total_placeholders"] = total
-    session["current_key"] = next_key
-
     state = {
         "placeholder_items": placeholder_items,
         "mapping": mapping,
@@ -166,6 +271,54 @@ def _get_workflow_state() -> dict[str, Any]:
     }
     return state
 
+def _get_workflow_state() -> dict[str, Any]:
+    """Request-scoped view of the workflow state.
+
+    Several endpoints (and _prompt_for_state callers) need the same state
+    within one request; compute it once and cache it on g.
+    """
+    if "workflow_state" not in g:
+        g.workflow_state = _compute_workflow_state()
+    return g.workflow_state
+
+def _commit_workflow_state(state: dict[str, Any]) -> None:
+    """Write the derived counters back to the session.
+
+    Only endpoints that change answers (or render the full page) call this;
+    read-only fragment GETs stay side-effect free so they never trigger a
+    session store write. Values are only assigned when they differ, so an
+    unchanged state leaves the session clean and skips re-encoding.
+    """
+    updates = {
+        "filled_count": state["filled"],
+        "total_placeholders": state["total"],
+        "current_key": state["next_key"],
+    }
+    for key, value in updates.items():
+        if session.get(key) != value:
+            session[key] = value
+
+def _state_etag(state: dict[str, Any]) -> str:
+    fingerprint = json.dumps(
+        [state["doc_name"], state["filled"], state["total"], state["next_key"], state["mapping"]],
+        sort_keys=True,
+    )
+    return hashlib.md5(fingerprint.encode()).hexdigest()
+
+def _fragment_response(template_name: str, state: dict[str, Any], **context):
+    """Render an HTMX fragment with an ETag derived from the workflow state.
+
+    Repeated polls with unchanged state short-circuit to an empty 304,
+    skipping the template render and the response body entirely.
+    """
+    etag = _state_etag(state)
+    if request.headers.get("If-None-Match") == etag:
+        return "", 304
+    response = make_response(render_template(template_name, **context, **state))
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, max-age=0, must-revalidate"
+    return response
+
 def _prompt_for_state(state: dict[str, Any]) -> str | None:
     next_key = state.get("next_key")
     if not next_key:
@@ -185,6 +338,7 @@ def chat():
 
     chat_history = session.get("chat_history") or []
     state = _get_workflow_state()
+    _commit_workflow_state(state)
     prompt_text = _prompt_for_state(state)
 
     return render_template(
@@ -201,24 +355,20 @@ def answer():
     if not key or msg == "":
         abort(400)
 
-    placeholders = session.get("placeholders") or []
-    if key not in placeholders:
-        placeholders.append(key)
-        session["placeholders"] = placeholders
-
-    chat_history = session.get("chat_history") or []
-    chat_history.append({"role": "you", "text": msg})
+    if key not in g.placeholders:
+        g.placeholders.append(key)
+        session["placeholders"] = g.placeholders
 
     val = msg
     if val.startswith("[") and val.endswith("]"):
         val = val[1:-1].strip()
 
-    mapping = session.get("mapping") or {}
-    mapping[key] = val
-    session["mapping"] = mapping
+    g.mapping[key] = val
+    session["mapping"] = g.mapping
     session["current_key"] = None
 
     state = _get_workflow_state()
+    _commit_workflow_state(state)
     nxt = state["next_key"]
     label = state.get("active_label")
     raw = state.get("active_raw")
@@ -232,8 +382,7 @@ def answer():
     else:
         bot_msg = "All set! Head to <b>Preview</b> to review or <b>Download</b> your .docx."
 
-    chat_history.append({"role": "bot", "text": bot_msg})
-    session["chat_history"] = chat_history
+    _append_chat({"role": "you", "text": msg}, {"role": "bot", "text": bot_msg})
 
     safe_msg = escape(msg)
     response_html = (
@@ -247,33 +396,30 @@ def answer():
 @app.get("/chat/sidebar")
 def chat_sidebar():
     state = _get_workflow_state()
-    return render_template("partials/chat_sidebar.html", **state)
+    return _fragment_response("partials/chat_sidebar.html", state)
 
 @app.get("/chat/input")
 def chat_input():
     state = _get_workflow_state()
     prompt_text = _prompt_for_state(state)
-    return render_template("partials/chat_input.html", prompt_text=prompt_text, **state)
+    return _fragment_response("partials/chat_input.html", state, prompt_text=prompt_text)
 
 @app.get("/fragments/progress-badge")
 def progress_badge():
     state = _get_workflow_state()
-    return render_template("partials/progress_badge.html", **state)
+    return _fragment_response("partials/progress_badge.html", state)
 
 @app.post("/set-current")
 def set_current():
     key = request.form.get("key")
-    placeholders = session.get("placeholders") or []
-    if not key or key not in placeholders:
+    if not key or key not in g.placeholders:
         abort(400)
 
     session["current_key"] = key
-    chat_history = session.get("chat_history") or []
     friendly = _humanize_placeholder(key)
     friendly_html = escape(friendly)
     raw_html = escape(key)
-    mapping = session.get("mapping") or {}
-    existing_value = mapping.get(key)
+    existing_value = g.mapping.get(key)
     details = ""
     if _is_filled(existing_value):
         details = f" Current value: <span class=\"muted\">{escape(existing_value)}</span>."
@@ -281,24 +427,21 @@ def set_current():
         f"Sure - let's update <b>{friendly_html}</b> <span class=\"muted\">({raw_html})</span>."
         f"{details}"
     )
+    chat_history = session.get("chat_history") or []
     if not chat_history or chat_history[-1].get("text") != message:
-        chat_history.append({"role": "bot", "text": message})
-    session["chat_history"] = chat_history
+        _append_chat({"role": "bot", "text": message})
     return redirect(url_for("chat"))
 
 @app.post("/clear-answer")
 def clear_answer():
     key = request.form.get("key")
-    placeholders = session.get("placeholders") or []
-    if not key or key not in placeholders:
+    if not key or key not in g.placeholders:
         abort(400)
 
-    mapping = session.get("mapping") or {}
-    mapping[key] = None
-    session["mapping"] = mapping
+    g.mapping[key] = None
+    session["mapping"] = g.mapping
     session["current_key"] = key
 
-    chat_history = session.get("chat_history") or []
     friendly = _humanize_placeholder(key)
     friendly_html = escape(friendly)
     raw_html = escape(key)
@@ -306,8 +449,7 @@ def clear_answer():
         f"Cleared the answer for <b>{friendly_html}</b> <span class=\"muted\">({raw_html})</span>. "
         "Let's add it again."
     )
-    chat_history.append({"role": "bot", "text": message})
-    session["chat_history"] = chat_history
+    _append_chat({"role": "bot", "text": message})
     return redirect(url_for("chat"))
 
 @app.get("/preview")
@@ -317,7 +459,13 @@ def preview():
         return redirect(url_for("index"))
     state = _get_workflow_state()
     mapping = state["mapping"]
-    preview_text = build_preview_text(doc_path, mapping)
+    scaffold_path = session.get("scaffold_path")
+    if scaffold_path and Path(scaffold_path).exists():
+        # Single open/read/close; no encoding round-trip before orjson.
+        scaffold = orjson.loads(Path(scaffold_path).read_bytes())
+        preview_text = render_scaffold(scaffold, mapping)
+    else:
+        preview_text = build_preview_text(doc_path, mapping)
     missing_items = [item for item in state["placeholder_items"] if not item["is_filled"]]
     return render_template(
         "preview.html",
@@ -329,31 +477,73 @@ def preview():
         filled=state["filled"],
     )
 
+def _download_name() -> str:
+    doc_name = session.get("doc_name") or "document"
+    safe_stem = secure_filename(Path(doc_name).stem) or "document"
+    return f"{safe_stem}_completed.docx"
+
+def _write_docx_job(doc_path: str, mapping: dict[str, str | None], final_path: Path) -> None:
+    """Fill placeholders into final_path; runs on the executor.
+
+    Writes to a temp name and renames at the end, so the existence of
+    final_path doubles as the atomic "job done" marker the status
+    endpoint checks.
+    """
+    tmp_path = final_path.with_suffix(".tmp")
+    try:
+        replace_placeholders(doc_path, mapping, str(tmp_path))
+        os.replace(tmp_path, final_path)
+    except Exception:
+        app.logger.exception("Download job failed for %s", doc_path)
+        tmp_path.unlink(missing_ok=True)
+        final_path.with_suffix(".err").touch()
+
 @app.get("/download")
 def download_docx():
     doc_path = session.get("doc_path")
-    mapping = session.get("mapping") or {}
     if not doc_path:
         abort(404)
-    doc_name = session.get("doc_name") or "document"
-    safe_stem = secure_filename(Path(doc_name).stem) or "document"
-    download_name = f"{safe_stem}_completed.docx"
-    out_path = OUTPUT_DIR / f"{uuid.uuid4().hex}_{download_name}"
 
-    replace_placeholders(doc_path, mapping, str(out_path))
+    _sweep_output_dir()
+    job_id = uuid.uuid4().hex
+    final_path = OUTPUT_DIR / f"{job_id}.docx"
+    _executor.submit(_write_docx_job, doc_path, dict(g.mapping), final_path)
+
+    return render_template("download.html", job_id=job_id, doc_name=session.get("doc_name"))
+
+@app.get("/download/status/<job_id>")
+def download_status(job_id: str):
+    if not JOB_ID_RE.fullmatch(job_id):
+        abort(400)
+    ready = (OUTPUT_DIR / f"{job_id}.docx").exists()
+    error_marker = OUTPUT_DIR / f"{job_id}.err"
+    error = error_marker.exists()
+    if error:
+        # The error partial doesn't re-poll, so the marker has served its
+        # purpose once reported.
+        error_marker.unlink(missing_ok=True)
+    return render_template("partials/download_status.html", job_id=job_id, ready=ready, error=error)
+
+@app.get("/download/file/<job_id>")
+def download_file(job_id: str):
+    if not JOB_ID_RE.fullmatch(job_id):
+        abort(400)
+    final_path = OUTPUT_DIR / f"{job_id}.docx"
+    if not session.get("doc_path") or not final_path.exists():
+        abort(404)
 
     @after_this_request
     def _cleanup(response):
         try:
-            out_path.unlink(missing_ok=True)
+            final_path.unlink(missing_ok=True)
         except OSError:
             pass
         return response
 
     return send_file(
-        str(out_path),
+        str(final_path),
         as_attachment=True,
-        download_name=download_name,
+        download_name=_download_name(),
         mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
     )
 
@@ -1,9 +1,21 @@
+import os
 import re
+import zipfile
 from collections import OrderedDict
+from functools import lru_cache
 from docx import Document
+from lxml import etree
 
 PLACEHOLDER_RE = re.compile(r"\[[^\[\]]+\]")  # e.g., [Company Name]
 
+_W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_P_TAG = f"{{{_W_NS}}}p"
+_R_TAG = f"{{{_W_NS}}}r"
+_T_TAG = f"{{{_W_NS}}}t"
+_TAB_TAG = f"{{{_W_NS}}}tab"
+_BR_TAG = f"{{{_W_NS}}}br"
+_CR_TAG = f"{{{_W_NS}}}cr"
+
 def _iter_paragraphs(element):
     """Yield all paragraphs within a document element, including nested tables."""
     if hasattr(element, "paragraphs"):
@@ -15,46 +27,168 @@ def _iter_paragraphs(element):
                 for cell in row.cells:
                     yield from _iter_paragraphs(cell)
 
-def _apply_mapping(text: str, mapping: dict[str, str | None]) -> str:
-    updated = text
-    for placeholder, value in mapping.items():
-        if not placeholder or value is None:
-            continue
-        replacement = str(value)
-        updated = updated.replace(placeholder, replacement)
-    return updated
+def _iter_paragraph_texts(doc_path: str):
+    """Yield paragraph texts straight from word/document.xml via lxml.
+
+    Read-only paths don't need python-docx's full object graph; streaming
+    <w:p> elements with iterparse skips the per-node wrapper allocation.
+    Tabs and breaks map to \\t and \\n, matching paragraph.text semantics.
+    Paragraphs arrive in true document order, tables included.
+    """
+    with zipfile.ZipFile(doc_path) as archive, archive.open("word/document.xml") as stream:
+        for _event, para in etree.iterparse(stream, tag=_P_TAG):
+            parts = []
+            # Only descend into runs: <w:tab> also appears inside <w:pPr>
+            # as a tab-stop definition, which carries no text.
+            for run in para.iter(_R_TAG):
+                for node in run.iter(_T_TAG, _TAB_TAG, _BR_TAG, _CR_TAG):
+                    if node.tag == _T_TAG:
+                        parts.append(node.text or "")
+                    elif node.tag == _TAB_TAG:
+                        parts.append("\t")
+                    else:
+                        parts.append("\n")
+            yield "".join(parts)
+            para.clear()
+
+@lru_cache(maxsize=32)
+def _load_paragraph_texts(doc_path: str, mtime_ns: int) -> tuple[str, ...]:
+    """Extract a docx's paragraph texts once.
+
+    Keyed on (path, mtime) so a rewritten file invalidates the cached entry.
+    Returns an immutable tuple so cached results can be shared safely.
+    """
+    return tuple(_iter_paragraph_texts(doc_path))
+
+def _paragraph_texts(doc_path: str) -> tuple[str, ...]:
+    mtime_ns = os.stat(doc_path).st_mtime_ns
+    return _load_paragraph_texts(doc_path, mtime_ns)
+
+def _compile_mapping(mapping: dict[str, str | None]) -> tuple[re.Pattern, dict[str, str]] | None:
+    """Build an alternation pattern over the filled mapping keys.
+
+    Compiled once per document pass so each paragraph costs a single
+    C-level regex scan with a dict lookup per hit. Returns None when no
+    placeholder has a value yet.
+    """
+    filled = {key: str(value) for key, value in mapping.items() if key and value is not None}
+    if not filled:
+        return None
+    pattern = re.compile("|".join(re.escape(key) for key in filled))
+    return pattern, filled
 
 def extract_placeholders(doc_path: str) -> list[str]:
-    doc = Document(doc_path)
     ordered = OrderedDict()
-    for paragraph in _iter_paragraphs(doc):
-        text = paragraph.text or ""
+    for text in _paragraph_texts(doc_path):
         for match in PLACEHOLDER_RE.findall(text):
             ordered.setdefault(match.strip(), None)
     return list(ordered.keys())
 
-def replace_placeholders(doc_path: str, mapping: dict[str, str | None], out_path: str) -> None:
+def build_scaffold(doc_path: str) -> list[dict]:
+    """Extract a JSON-serializable preview scaffold from a docx.
+
+    Each entry holds a paragraph's text plus the (start, end, key) spans of
+    the placeholders it contains, so previews can be rendered without
+    touching python-docx again.
+    """
+    scaffold = []
+    for text in _paragraph_texts(doc_path):
+        phs = [
+            [match.start(), match.end(), match.group(0).strip()]
+            for match in PLACEHOLDER_RE.finditer(text)
+        ]
+        scaffold.append({"text": text, "phs": phs})
+    return scaffold
+
+def scaffold_placeholders(scaffold: list[dict]) -> list[str]:
+    ordered = OrderedDict()
+    for entry in scaffold:
+        for _start, _end, key in entry["phs"]:
+            ordered.setdefault(key, None)
+    return list(ordered.keys())
+
+def render_scaffold(scaffold: list[dict], mapping: dict[str, str | None]) -> str:
+    # Before any answer arrives the mapping is all None; skip the span walk
+    # entirely and just join the stored paragraph texts.
+    filled = {key: str(value) for key, value in (mapping or {}).items() if key and value is not None}
+    buf = []
+    for entry in scaffold:
+        text = entry["text"]
+        spans = entry["phs"]
+        if spans and filled:
+            parts = []
+            cursor = 0
+            for start, end, key in spans:
+                value = filled.get(key)
+                if value is None:
+                    continue
+                parts.append(text[cursor:start])
+                parts.append(value)
+                cursor = end
+            parts.append(text[cursor:])
+            text = "".join(parts)
+        if text.strip():
+            buf.append(text)
+    return "\n\n".join(buf)
+
+def _rewrite_runs(paragraph, pattern: re.Pattern, filled: dict[str, str], updated: str) -> None:
+    """Substitute placeholders at run level, preserving run formatting.
+
+    Placeholders contained within a single run are replaced in place, leaving
+    every other run (and its formatting) untouched. Only when a placeholder
+    spans run boundaries do we collapse the paragraph text into the first
+    run — still gentler than the paragraph.text setter, which drops all runs.
+    """
+    runs = paragraph.runs
+    for run in runs:
+        text = run.text or ""
+        if "[" not in text:
+            continue
+        new_text = pattern.sub(lambda match: filled[match.group(0)], text)
+        if new_text != text:
+            run.text = new_text
+
+    if (paragraph.text or "") == updated:
+        return
+    # A placeholder spans run boundaries. Collapsing into the first run is
+    # only safe when every bit of paragraph text lives in the direct runs;
+    # with other inline content (e.g. a hyperlink, whose text is part of
+    # `updated` but not of `runs`) it would duplicate that text, so fall
+    # back to the paragraph-level rewrite, which clears all content.
+    direct_text = "".join(run.text or "" for run in runs)
+    if runs and direct_text == (paragraph.text or ""):
+        runs[0].text = updated
+        for run in runs[1:]:
+            run.text = ""
+    else:
+        paragraph.text = updated
+
+def replace_placeholders(doc_path: str, mapping: dict[str, str | None], out) -> None:
+    """Fill placeholders and save the result to `out` (path or file-like)."""
     doc = Document(doc_path)
-    if not mapping:
-        doc.save(out_path)
+    compiled = _compile_mapping(mapping or {})
+    if compiled is None:
+        doc.save(out)
         return
 
+    pattern, filled = compiled
     for paragraph in _iter_paragraphs(doc):
         original = paragraph.text or ""
-        if not original:
+        if "[" not in original:
             continue
-        updated = _apply_mapping(original, mapping)
+        updated = pattern.sub(lambda match: filled[match.group(0)], original)
         if updated != original:
-            paragraph.text = updated
+            _rewrite_runs(paragraph, pattern, filled, updated)
 
-    doc.save(out_path)
+    doc.save(out)
 
 def build_preview_text(doc_path: str, mapping: dict[str, str | None]) -> str:
-    doc = Document(doc_path)
+    compiled = _compile_mapping(mapping or {})
     buf = []
-    for paragraph in _iter_paragraphs(doc):
-        text = paragraph.text or ""
-        updated = _apply_mapping(text, mapping)
-        if updated.strip():
-            buf.append(updated)
+    for text in _paragraph_texts(doc_path):
+        if compiled is not None and "[" in text:
+            pattern, filled = compiled
+            text = pattern.sub(lambda match: filled[match.group(0)], text)
+        if text.strip():
+            buf.append(text)
     return "\n\n".join(buf)